@@ -13,3 +13,19 @@ def register(model, cls=None):
         cls = ModelSyncer
     __registry__.register(model, cls)
 
+
+# How many seconds wait_for() blocks before giving up.
+WAIT_TIMEOUT = 10
+
+
+def get_sync_tokens(instance):
+    """Returns the sync tokens of every event this process has queued for
+    the instance."""
+    return list(getattr(instance._state, 'sync_tokens', []))
+
+
+def wait_for(token, timeout=WAIT_TIMEOUT):
+    """Blocks until the target has applied a sync token, or an iterable of
+    them, and returns True. Returns False if the timeout expires first."""
+    from .tokens import wait_for
+    return wait_for(token, timeout)
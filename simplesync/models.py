@@ -28,6 +28,13 @@ def fail_silently(fn):
 
 
 class ModelSyncer(object):
+    # Name of an entry in settings.SIMPLESYNC_PRIORITY_CLASSES. Each entry
+    # holds apply_async() options (queue, priority...) and an optional
+    # 'rate_limit' in Celery's syntax ('100/s'), which workers enforce for
+    # that class alone. Give a model its own class to limit it by itself.
+    # Events are only ordered within a class, so models related to this one
+    # by foreign keys or many-to-many relations should share it.
+    priority_class = None
 
     def __init__(self, model):
         self.model = model
@@ -46,6 +53,42 @@ class ModelSyncer(object):
     def pk_or_nk(self, obj):
         return obj.natural_key() if self.uses_natural_key(obj) else obj.pk
 
+    def get_task_options(self):
+        if self.priority_class is None:
+            return {}
+        priority_classes = getattr(settings, 'SIMPLESYNC_PRIORITY_CLASSES', {})
+        try:
+            options = dict(priority_classes[self.priority_class])
+        except KeyError:
+            logger.warning('Priority class %r for %s is not defined in '
+                           'SIMPLESYNC_PRIORITY_CLASSES - using default routing',
+                           self.priority_class, self.get_model_name(self.model))
+            return {}
+        # Enforced by the class's task on the worker, not by apply_async().
+        options.pop('rate_limit', None)
+        return options
+
+    def enqueue(self, operation, app_label, model_name, original_key, json_str):
+        """Queues an event for the target and returns a SyncToken for it,
+        which can be passed to simplesync.wait_for()."""
+        from . import tasks, tokens
+        partition = tokens.get_partition(app_label, model_name)
+        epoch, sequence = tokens.next_sequence(partition)
+        options = self.get_task_options()
+        task = tasks.get_task(self.priority_class)
+        result = task.apply_async(
+            (operation, app_label, model_name, original_key, json_str,
+             epoch, sequence),
+            **options)
+        return tokens.SyncToken(partition, epoch, sequence, result.id)
+
+    def remember_token(self, instance, token):
+        # Every token is kept: a later event can be applied before an
+        # earlier one in the same partition.
+        if not hasattr(instance._state, 'sync_tokens'):
+            instance._state.sync_tokens = []
+        instance._state.sync_tokens.append(token)
+
     @fail_silently
     def pre_save_or_delete_handler(self, sender=None, instance=None, raw=None, using=None,
                                    update_fields=None, **kwargs):
@@ -70,7 +113,6 @@ class ModelSyncer(object):
     @fail_silently
     def post_save_handler(self, sender=None, instance=None, created=None,
                           raw=None, using=None, update_fields=None, **kwargs):
-        from . import tasks
         if raw:
             logger.warning('Received "raw" save request for %s %s - declining '
                            'to operate', self.get_model_name(sender), instance.pk)
@@ -83,14 +125,15 @@ class ModelSyncer(object):
                 return
             # Re-GET the instance to ensure that all FK's are realized
             requeried_obj = self.model._default_manager.get(pk=instance.pk)
-            result = tasks.do_sync.delay('create',
-                                         sender._meta.app_label,
-                                         self.get_model_name(sender),
-                                         None,  # original_key
-                                         self.to_json(requeried_obj))
+            token = self.enqueue('create',
+                                 sender._meta.app_label,
+                                 self.get_model_name(sender),
+                                 None,  # original_key
+                                 self.to_json(requeried_obj))
             logger.info('CREATE - %s %s - queued as %s',
                         self.get_model_name(sender), self.pk_or_nk(instance),
-                        result.id)
+                        token.task_id)
+            self.remember_token(instance, token)
             return
         else:
             if not self.can_update(instance):
@@ -100,31 +143,32 @@ class ModelSyncer(object):
                 return
             # Re-GET the instance to ensure that all FK's are realized
             requeried_obj = self.model._default_manager.get(pk=instance.pk)
-            result = tasks.do_sync.delay('update',
-                                         sender._meta.app_label,
-                                         self.get_model_name(sender),
-                                         instance._state.original_key,
-                                         self.to_json(requeried_obj))
+            token = self.enqueue('update',
+                                 sender._meta.app_label,
+                                 self.get_model_name(sender),
+                                 instance._state.original_key,
+                                 self.to_json(requeried_obj))
             logger.info('UPDATE - %s %s - queued as %s',
                         self.get_model_name(sender), self.pk_or_nk(instance),
-                        result.id)
+                        token.task_id)
+            self.remember_token(instance, token)
             return
 
     @fail_silently
     def post_delete_handler(self, sender=None, instance=None, using=None,
                             **kwargs):
-        from . import tasks
         if not self.can_delete(instance):
             logger.debug('Received delete signal for %s %s - but not '
                          'authorized by can_delete',
                          self.get_model_name(sender), instance.pk)
             return
         json_body = {'pk': instance._state.original_key}
-        result = tasks.do_sync.delay(
+        token = self.enqueue(
             'delete', sender._meta.app_label, self.get_model_name(sender), None,
             json.dumps(json_body, cls=DateTimeAwareJSONEncoder))
         logger.info('DELETE - %s %s - queued as %s',
-                    self.get_model_name(sender), json_body, result.id)
+                    self.get_model_name(sender), json_body, token.task_id)
+        self.remember_token(instance, token)
 
     @fail_silently
     def m2m_changed_handler(self, sender=None, instance=None, action=None,
@@ -138,7 +182,6 @@ class ModelSyncer(object):
         syncer = type(self)(ThroughClass)
         instance_model_name = self.get_model_name(type(instance))
 
-        from . import tasks
         if action == 'post_add' and self.can_add_m2m(type(instance), model):
             # Treat this like a create
             for pk in pk_set:
@@ -147,14 +190,15 @@ class ModelSyncer(object):
                        self.get_model_name(model): pk}
                 )
                 # We need a JSON generator with this model now...
-                result = tasks.do_sync.delay('create',
-                                             sender._meta.app_label,
-                                             self.get_model_name(ThroughClass),
-                                             None,  # original_key
-                                             syncer.to_json(obj))
+                token = self.enqueue('create',
+                                     sender._meta.app_label,
+                                     self.get_model_name(ThroughClass),
+                                     None,  # original_key
+                                     syncer.to_json(obj))
                 logger.info('CREATE - %s %s - queued as %s',
                             self.get_model_name(ThroughClass), self.pk_or_nk(instance),
-                            result.id)
+                            token.task_id)
+                self.remember_token(instance, token)
             return
 
         if action == 'post_remove' and \
@@ -163,12 +207,13 @@ class ModelSyncer(object):
                 json_body = {instance_model_name: self.pk_or_nk(instance)}
                 related_obj = model.objects.get(pk=pk)
                 json_body[self.get_model_name(model)] = self.pk_or_nk(related_obj)
-                result = tasks.do_sync.delay(
+                token = self.enqueue(
                     'delete', ThroughClass._meta.app_label,
                     self.get_model_name(ThroughClass),
                     None, json.dumps(json_body, cls=DateTimeAwareJSONEncoder))
                 logger.info('DELETE - %s %s - queued as %s',
-                            self.get_model_name(sender), json_body, result.id)
+                            self.get_model_name(sender), json_body, token.task_id)
+                self.remember_token(instance, token)
 
         if action == 'pre_clear' and \
                 self.can_remove_m2m(type(instance), model):
@@ -186,11 +231,12 @@ class ModelSyncer(object):
         if action == 'post_clear' and \
                 self.can_remove_m2m(type(instance), model):
             for json_body in instance._state.m2m_clear_pks:
-                result = tasks.do_sync.delay(
+                token = self.enqueue(
                     'delete', sender._meta.app_label, self.get_model_name(ThroughClass),
                     None, json.dumps(json_body, cls=DateTimeAwareJSONEncoder))
                 logger.info('DELETE - %s %s - queued as %s',
-                            self.get_model_name(ThroughClass), json_body, result.id)
+                            self.get_model_name(ThroughClass), json_body, token.task_id)
+                self.remember_token(instance, token)
 
     def can_add_m2m(self, model, other_model):
         return is_registered(model) and is_registered(other_model)
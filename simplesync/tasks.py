@@ -9,6 +9,11 @@ import json
 import importlib
 
 from celery import current_app
+try:
+    from celery.exceptions import Retry
+except ImportError:
+    # Celery < 3.1
+    from celery.exceptions import RetryTaskError as Retry
 from django.core.serializers.base import DeserializationError
 from django.db import models
 try:
@@ -23,14 +28,57 @@ except ImportError:
     from django.db.transaction import commit_on_success as atomic #noqa
 from django.conf import settings
 
+from . import tokens
+
 NULLIFY_ALL_PKS = getattr(settings, 'SIMPLESYNC_NULLIFY_ALL_PKS', False)
 LEGACY_PK_FIELD = getattr(settings, 'SIMPLESYNC_LEGACY_PK_FIELD', None)
 SYNCER_CLS = getattr(settings, 'SIMPLESYNC_SYNCER_CLS', 'simplesync.models.ModelSyncer')
 
-@current_app.task(name='simplesync-task', ignore_result=True, max_retries=5)
-def do_sync(operation, app_label, model_name, original_key, json_str):
+PRIORITY_CLASSES = getattr(settings, 'SIMPLESYNC_PRIORITY_CLASSES', {})
+
+def sync_task(name, **options):
+    @current_app.task(name=name, ignore_result=True, max_retries=5, **options)
+    def task(operation, app_label, model_name, original_key, json_str,
+             epoch=None, sequence=None):
+        retrying = False
+        try:
+            _do_sync(task, operation, app_label, model_name, original_key,
+                     json_str)
+        except Retry:
+            retrying = True
+            raise
+        finally:
+            # Once retries run out Celery re-raises the original error, so
+            # this runs for every outcome but a retry. A failed event is
+            # still done as far as waiters are concerned; it has been logged.
+            if sequence is not None and not retrying:
+                # Token problems must never change the task's outcome.
+                try:
+                    tokens.mark_applied(
+                        tokens.get_partition(app_label, model_name),
+                        epoch, sequence)
+                except Exception:
+                    logger.exception('%s - Could not mark %s.%s %s:%s as '
+                                     'applied', task.request.id, app_label,
+                                     model_name, epoch, sequence)
+    return task
+
+do_sync = sync_task('simplesync-task')
+
+# Celery enforces rate limits per task type, so each priority class with a
+# 'rate_limit' gets a task of its own.
+RATE_LIMITED_TASKS = dict(
+    (name, sync_task('simplesync-task.%s' % name,
+                     rate_limit=options['rate_limit']))
+    for name, options in PRIORITY_CLASSES.items()
+    if options.get('rate_limit'))
+
+def get_task(priority_class):
+    return RATE_LIMITED_TASKS.get(priority_class, do_sync)
+
+def _do_sync(task, operation, app_label, model_name, original_key, json_str):
     model_cls = models.get_model(app_label, model_name)
-    logger.info('%s - %s.%s - %s', do_sync.request.id, app_label, model_name, original_key)
+    logger.info('%s - %s.%s - %s', task.request.id, app_label, model_name, original_key)
     mod_name, syncer_cls_name = SYNCER_CLS.rsplit('.', 1)
     mod = importlib.import_module(mod_name)
     syncer_cls = getattr(mod, syncer_cls_name)
@@ -48,7 +96,7 @@ def do_sync(operation, app_label, model_name, original_key, json_str):
                         except model_cls.DoesNotExist:
                             logger.warning('%s - DELETE - Could not find %s '
                                            'instance with natural key %s - aborting.',
-                                           do_sync.request.id, model_cls, value)
+                                           task.request.id, model_cls, value)
                             return
                         continue
                     try:
@@ -62,14 +110,14 @@ def do_sync(operation, app_label, model_name, original_key, json_str):
                     except field.rel.to.DoesNotExist:
                         logger.warning('%s - DELETE - Could not find related %s '
                                        'instance with natural key %s - aborting.',
-                                       do_sync.request.id, field.rel.to, value)
+                                       task.request.id, field.rel.to, value)
                         return
                     json_obj[key] = obj.pk
             try:
                 model_cls.objects.filter(**json_obj).delete()
             except TypeError:
-                logger.exception('%s - %s', do_sync.request.id, json_obj)
-        logger.info('%s - DELETED - %s - %s', do_sync.request.id, model_cls, json_obj)
+                logger.exception('%s - %s', task.request.id, json_obj)
+        logger.info('%s - DELETED - %s - %s', task.request.id, model_cls, json_obj)
     if operation == 'create':
         new_obj = None
         try:
@@ -78,7 +126,7 @@ def do_sync(operation, app_label, model_name, original_key, json_str):
                 # If we're relying on natural keys, drop the pk value
                 if syncer.uses_natural_key(new_obj) or NULLIFY_ALL_PKS:
                     logger.info('%s - %s.%s - before create, nulling PK',
-                                do_sync.request.id, app_label, model_name)
+                                task.request.id, app_label, model_name)
                     if LEGACY_PK_FIELD and hasattr(new_obj, LEGACY_PK_FIELD):
                         setattr(new_obj, LEGACY_PK_FIELD, new_obj.pk)
                     new_obj.pk = None
@@ -90,22 +138,22 @@ def do_sync(operation, app_label, model_name, original_key, json_str):
                 DatabaseError,
                 DeserializationError), e:
             if new_obj:
-                logger.warning('%s - Create failed: %s - %s', do_sync.request.id,
+                logger.warning('%s - Create failed: %s - %s', task.request.id,
                                unicode(new_obj), e)
             else:
-                logger.warning('%s - Create failed: %s - %s - %s', do_sync.request.id,
+                logger.warning('%s - Create failed: %s - %s - %s', task.request.id,
                                model_cls, json_str, e)
             try:
-                raise do_sync.retry(exc=e)
-            except do_sync.MaxRetriesExceededError, e:
+                raise task.retry(exc=e)
+            except task.MaxRetriesExceededError, e:
                 if new_obj:
-                    logger.error('%s - Create failed permanently: %s', do_sync.request.id,
+                    logger.error('%s - Create failed permanently: %s', task.request.id,
                                  unicode(new_obj))
                 else:
-                    logger.error('%s - Create failed permanently: %s', do_sync.request.id,
+                    logger.error('%s - Create failed permanently: %s', task.request.id,
                                  json_str)
         else:
-            logger.info('%s - CREATED - %s %s (%s)', do_sync.request.id, model_cls,
+            logger.info('%s - CREATED - %s %s (%s)', task.request.id, model_cls,
                         unicode(new_obj), new_obj.pk)
     if operation == 'update':
         updated_obj = None
@@ -117,23 +165,23 @@ def do_sync(operation, app_label, model_name, original_key, json_str):
                 else:
                     original_obj = model_cls._default_manager.get(pk=original_key)
                 logger.info('%s - %s.%s - before update, using PK %d',
-                            do_sync.request.id, app_label, model_name, original_obj.pk)
+                            task.request.id, app_label, model_name, original_obj.pk)
                 updated_obj.pk = original_obj.pk
                 updated_obj.save(force_update=True)
         except (models.ObjectDoesNotExist,
                 DatabaseError,
                 DeserializationError), e:
             if updated_obj:
-                logger.warning('%s - Update failed: %s - %s', do_sync.request.id, unicode(updated_obj), e)
+                logger.warning('%s - Update failed: %s - %s', task.request.id, unicode(updated_obj), e)
             else:
-                logger.warning('%s - Update failed: %s - %s - %s', do_sync.request.id, model_cls, json_str, e)
+                logger.warning('%s - Update failed: %s - %s - %s', task.request.id, model_cls, json_str, e)
             try:
-                raise do_sync.retry(exc=e)
-            except do_sync.MaxRetriesExceededError, e:
+                raise task.retry(exc=e)
+            except task.MaxRetriesExceededError, e:
                 if updated_obj:
-                    logger.error('%s - Update failed permanently: %s', do_sync.request.id, unicode(updated_obj))
+                    logger.error('%s - Update failed permanently: %s', task.request.id, unicode(updated_obj))
                 else:
-                    logger.error('%s - Update failed permanently: %s', do_sync.request.id, json_str)
+                    logger.error('%s - Update failed permanently: %s', task.request.id, json_str)
         else:
-            logger.info('%s - UPDATED - %s %s (%s)', do_sync.request.id, model_cls,
+            logger.info('%s - UPDATED - %s %s (%s)', task.request.id, model_cls,
                         unicode(updated_obj), updated_obj.pk)
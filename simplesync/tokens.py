@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+import collections
+import time
+import uuid
+
+import django
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.core.cache import caches
+    get_cache = lambda alias: caches[alias]
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+
+from . import WAIT_TIMEOUT
+
+SyncToken = collections.namedtuple('SyncToken',
+                                   ['partition', 'epoch', 'sequence', 'task_id'])
+
+
+def get_token_cache():
+    """Returns the cache named by settings.SIMPLESYNC_TOKEN_CACHE, which
+    must be shared by the source and the target. Sequences are only handed
+    out, and wait_for() only works, when it is set. The cache must provide
+    an atomic incr() and honour a timeout of None, as the memcached and
+    redis backends do on Django 1.7 and later. Losing keys is safe but
+    makes waiters time out."""
+    alias = getattr(settings, 'SIMPLESYNC_TOKEN_CACHE', None)
+    if not alias:
+        return None
+    if django.VERSION < (1, 7):
+        # Older caches read a timeout of None as the default timeout, or in
+        # 1.6's locmem backend, as already expired.
+        raise ImproperlyConfigured('SIMPLESYNC_TOKEN_CACHE requires '
+                                   'Django 1.7 or later')
+    return get_cache(alias)
+
+
+def get_token_timeout():
+    # How long the per-event "applied" markers are kept, in seconds.
+    return getattr(settings, 'SIMPLESYNC_TOKEN_TIMEOUT', 60 * 60)
+
+
+def get_partition(app_label, model_name):
+    return '%s.%s' % (app_label, model_name)
+
+
+def make_key(*parts):
+    return 'simplesync:%s' % ':'.join(str(part) for part in parts)
+
+
+def get_epoch(cache, partition):
+    epoch_key = make_key('epoch', partition)
+    epoch = cache.get(epoch_key)
+    if epoch is None:
+        # The counter is created before the epoch is published, so a missing
+        # counter for a published epoch always means it was lost.
+        epoch = uuid.uuid4().hex
+        seq_key = make_key('seq', partition, epoch)
+        cache.add(seq_key, 0, None)
+        if not cache.add(epoch_key, epoch, None):
+            cache.delete(seq_key)
+            epoch = cache.get(epoch_key)
+    return epoch
+
+
+def allocate_sequence(cache, partition):
+    epoch = get_epoch(cache, partition)
+    try:
+        return epoch, cache.incr(make_key('seq', partition, epoch))
+    except ValueError:
+        logger.warning('Sequence for %s was lost - starting a new epoch',
+                       partition)
+    # Only retire the epoch if nobody has replaced it already.
+    epoch_key = make_key('epoch', partition)
+    if cache.get(epoch_key) == epoch:
+        cache.delete(epoch_key)
+    epoch = get_epoch(cache, partition)
+    return epoch, cache.incr(make_key('seq', partition, epoch))
+
+
+def next_sequence(partition):
+    """Returns an (epoch, sequence) pair for a new event. A partition's
+    counter lives under a random epoch, and every key derived from a
+    sequence includes it. If the counter is ever lost, a new epoch is
+    started rather than reusing numbers that old markers still cover.
+
+    Tokens are optional, so any failure here is logged and (None, None)
+    returned; the event itself must still be queued."""
+    try:
+        cache = get_token_cache()
+        if cache is None:
+            return None, None
+        return allocate_sequence(cache, partition)
+    except Exception:
+        logger.exception('Could not allocate a sync token for %s - queueing '
+                         'without one', partition)
+        return None, None
+
+
+def mark_applied(partition, epoch, sequence):
+    """Called by the target once it is done with an event. Each sequence
+    gets its own short-lived marker, and the partition's high-water mark is
+    advanced over every contiguous marker. Each step is claimed with add()
+    so that concurrent workers never advance past the same sequence twice."""
+    cache = get_token_cache()
+    if cache is None:
+        return
+    timeout = get_token_timeout()
+    cache.set(make_key('applied', partition, epoch, sequence), True, timeout)
+    hwm_key = make_key('hwm', partition, epoch)
+    cache.add(hwm_key, 0, None)
+    while True:
+        next_seq = (cache.get(hwm_key) or 0) + 1
+        if not cache.get(make_key('applied', partition, epoch, next_seq)):
+            break
+        if not cache.add(make_key('claim', partition, epoch, next_seq), True,
+                         timeout):
+            break
+        cache.incr(hwm_key)
+
+
+def is_applied(token):
+    cache = get_token_cache()
+    hwm_key = make_key('hwm', token.partition, token.epoch)
+    applied_key = make_key('applied', token.partition, token.epoch,
+                           token.sequence)
+    values = cache.get_many([hwm_key, applied_key])
+    # The marker covers events applied out of order, or after an earlier
+    # event in the partition was lost and stalled the high-water mark.
+    return values.get(hwm_key, 0) >= token.sequence or \
+        bool(values.get(applied_key))
+
+
+def wait_for(token, timeout=WAIT_TIMEOUT):
+    """Blocks until the target has applied the given token (or iterable of
+    tokens), polling with a growing interval. Returns False if the timeout
+    expires first. Tokens queued without a sequence are not waited for."""
+    if isinstance(token, SyncToken):
+        pending = [token]
+    else:
+        pending = list(token)
+    pending = [t for t in pending if t.sequence is not None]
+    if pending and get_token_cache() is None:
+        raise ImproperlyConfigured('SIMPLESYNC_TOKEN_CACHE must be set to '
+                                   'wait for sync tokens')
+    deadline = None if timeout is None else time.time() + timeout
+    interval = 0.01
+    while True:
+        pending = [t for t in pending if not is_applied(t)]
+        if not pending:
+            return True
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.debug('Timed out waiting for %s', pending)
+                return False
+            interval = min(interval, remaining)
+        time.sleep(interval)
+        interval = min(interval * 2, 0.5)
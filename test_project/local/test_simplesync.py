@@ -0,0 +1,176 @@
+from unittest import skipIf
+
+import django
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from simplesync import tasks, tokens
+from simplesync.models import ModelSyncer
+
+from .models import TestModel
+
+
+class LowPrioritySyncer(ModelSyncer):
+    priority_class = 'low'
+
+
+class BulkSyncer(ModelSyncer):
+    priority_class = 'bulk'
+
+
+class FakeResult(object):
+    id = 'task-id'
+
+
+@override_settings(SIMPLESYNC_PRIORITY_CLASSES={
+    'low': {'queue': 'simplesync-low', 'priority': 0}})
+class TaskOptionsTest(TestCase):
+    def test_no_priority_class(self):
+        self.assertEqual(ModelSyncer(TestModel).get_task_options(), {})
+
+    def test_priority_class(self):
+        self.assertEqual(LowPrioritySyncer(TestModel).get_task_options(),
+                         {'queue': 'simplesync-low', 'priority': 0})
+
+    def test_options_are_copied(self):
+        syncer = LowPrioritySyncer(TestModel)
+        syncer.get_task_options()['countdown'] = 5
+        self.assertNotIn('countdown', syncer.get_task_options())
+
+    def test_unknown_priority_class(self):
+        syncer = LowPrioritySyncer(TestModel)
+        syncer.priority_class = 'missing'
+        self.assertEqual(syncer.get_task_options(), {})
+
+
+@override_settings(SIMPLESYNC_TOKEN_CACHE=None)
+class EnqueueTest(TestCase):
+    def setUp(self):
+        self.calls = []
+        for task in (tasks.do_sync, tasks.get_task('bulk')):
+            task.apply_async = self.apply_async
+
+    def tearDown(self):
+        for task in (tasks.do_sync, tasks.get_task('bulk')):
+            del task.apply_async
+
+    def apply_async(self, args, **options):
+        self.calls.append((args, options))
+        return FakeResult()
+
+    def test_default_routing(self):
+        token = ModelSyncer(TestModel).enqueue(
+            'create', 'local', 'testmodel', None, '[]')
+        self.assertEqual(self.calls, [
+            (('create', 'local', 'testmodel', None, '[]', None, None), {})])
+        self.assertEqual(token.task_id, 'task-id')
+
+    @override_settings(SIMPLESYNC_PRIORITY_CLASSES={
+        'low': {'queue': 'simplesync-low', 'priority': 0}})
+    def test_priority_class(self):
+        LowPrioritySyncer(TestModel).enqueue(
+            'create', 'local', 'testmodel', None, '[]')
+        self.assertEqual(self.calls[0][1],
+                         {'queue': 'simplesync-low', 'priority': 0})
+
+    def test_rate_limited_class(self):
+        task = tasks.get_task('bulk')
+        self.assertNotEqual(task.name, tasks.do_sync.name)
+        self.assertEqual(task.rate_limit, '100/s')
+        BulkSyncer(TestModel).enqueue(
+            'create', 'local', 'testmodel', None, '[]')
+        self.assertEqual(self.calls[0][1],
+                         {'queue': 'simplesync-bulk', 'priority': 0})
+
+    @override_settings(SIMPLESYNC_TOKEN_CACHE='default')
+    def test_token_cache_failure(self):
+        def incr(cache, key, delta=1, version=None):
+            raise ValueError(key)
+        original_incr = LocMemCache.incr
+        LocMemCache.incr = incr
+        try:
+            token = ModelSyncer(TestModel).enqueue(
+                'create', 'local', 'testmodel', None, '[]')
+        finally:
+            LocMemCache.incr = original_incr
+        self.assertEqual(self.calls, [
+            (('create', 'local', 'testmodel', None, '[]', None, None), {})])
+        self.assertEqual(token.sequence, None)
+
+
+@skipIf(django.VERSION < (1, 7), 'Sync tokens require Django 1.7')
+@override_settings(SIMPLESYNC_TOKEN_CACHE='default')
+class SyncTokenTest(TestCase):
+    partition = 'local.testmodel'
+
+    def setUp(self):
+        tokens.get_token_cache().clear()
+
+    def make_token(self):
+        epoch, sequence = tokens.next_sequence(self.partition)
+        return tokens.SyncToken(self.partition, epoch, sequence, None)
+
+    def test_sequences_increase(self):
+        first, second = self.make_token(), self.make_token()
+        self.assertEqual(first.epoch, second.epoch)
+        self.assertEqual((first.sequence, second.sequence), (1, 2))
+
+    def test_lost_counter_starts_new_epoch(self):
+        first = self.make_token()
+        tokens.mark_applied(self.partition, first.epoch, first.sequence)
+        tokens.get_token_cache().delete(
+            tokens.make_key('seq', self.partition, first.epoch))
+        second = self.make_token()
+        self.assertNotEqual(first.epoch, second.epoch)
+        self.assertFalse(tokens.is_applied(second))
+
+    def test_out_of_order(self):
+        first, second = self.make_token(), self.make_token()
+        tokens.mark_applied(self.partition, second.epoch, second.sequence)
+        self.assertFalse(tokens.is_applied(first))
+        self.assertTrue(tokens.is_applied(second))
+        self.assertFalse(tokens.wait_for([first, second], timeout=0.05))
+        tokens.mark_applied(self.partition, first.epoch, first.sequence)
+        hwm_key = tokens.make_key('hwm', self.partition, first.epoch)
+        self.assertEqual(tokens.get_token_cache().get(hwm_key), 2)
+        self.assertTrue(tokens.wait_for([first, second], timeout=0.05))
+
+    def test_timeout(self):
+        self.assertFalse(tokens.wait_for(self.make_token(), timeout=0.05))
+
+    def test_untracked_token(self):
+        token = tokens.SyncToken(self.partition, None, None, 'task-id')
+        self.assertTrue(tokens.wait_for(token, timeout=0))
+
+    def test_lost_epoch_race(self):
+        # A process that loses the race to publish an epoch drops its
+        # counter and uses the winner's.
+        cache = tokens.get_token_cache()
+        winner = self.make_token().epoch
+
+        class RacingCache(object):
+            missed = False
+
+            def __getattr__(self, name):
+                return getattr(cache, name)
+
+            def get(self, key, *args, **kwargs):
+                if not self.missed:
+                    self.missed = True
+                    return None
+                return cache.get(key, *args, **kwargs)
+
+        self.assertEqual(tokens.get_epoch(RacingCache(), self.partition),
+                         winner)
+        counters = [key for key in cache._cache if ':simplesync:seq:' in key]
+        self.assertEqual(len(counters), 1)
+
+    @override_settings(SIMPLESYNC_TOKEN_CACHE=None)
+    def test_no_token_cache(self):
+        self.assertEqual(tokens.next_sequence(self.partition), (None, None))
+        untracked = tokens.SyncToken(self.partition, None, None, 'task-id')
+        self.assertTrue(tokens.wait_for([untracked]))
+        tracked = tokens.SyncToken(self.partition, 'epoch', 1, 'task-id')
+        self.assertRaises(ImproperlyConfigured, tokens.wait_for, [tracked])
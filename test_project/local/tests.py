@@ -4,9 +4,10 @@
 # So run this script from a manage.py shell while another process runs
 # manage.py celery worker -l DEBUG --settings=test_project.other_settings
 
-import time
 from django.utils.timezone import now
 
+from simplesync import get_sync_tokens, wait_for
+
 from .models import *
 
 def test_script():
@@ -69,5 +70,8 @@ def test_script():
     m2mrms.testmodel_set.remove(tm)
     m2mrms.delete()
 
-    time.sleep(2)
+    sync_tokens = []
+    for obj in (rm, rms, m2mrm, m2mrm2, m2mrms, m2mrms2, tm, rrm, rm2mrm):
+        sync_tokens.extend(get_sync_tokens(obj))
+    assert wait_for(sync_tokens, timeout=10)
     # tm.delete()
@@ -65,6 +65,23 @@ DATABASES = {
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Sync tokens need a cache shared by this project and the "other" settings,
+# with an atomic, non-expiring incr(), so memcached or redis rather than a
+# file or database cache. Set SIMPLESYNC_MEMCACHED to e.g. 127.0.0.1:11211
+# (python-memcached must be installed) to try them with tests.test_script.
+if os.environ.get('SIMPLESYNC_MEMCACHED'):
+    CACHES['simplesync'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ['SIMPLESYNC_MEMCACHED'],
+    }
+    SIMPLESYNC_TOKEN_CACHE = 'simplesync'
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -106,3 +123,8 @@ LOGGING = {
 }
 
 DO_SYNC = True
+
+# The "other" settings share these, so that workers enforce the rate limit.
+SIMPLESYNC_PRIORITY_CLASSES = {
+    'bulk': {'queue': 'simplesync-bulk', 'priority': 0, 'rate_limit': '100/s'},
+}